@@ -5,6 +5,9 @@ import zipfile
 from collections import UserDict
 import re
 import datetime
+import errno
+import time
+from concurrent.futures import ThreadPoolExecutor
 from fuzzywuzzy import fuzz
 
 
@@ -269,8 +272,11 @@ class NoteBook(UserDict):
 
 
 class Sorter:
-    def __init__(self):
+    def __init__(self, sniff_content: bool = False, sniff_bytes: int = 512, sniff_workers: int = 8):
         self.filepath = ""
+        self.sniff_content = sniff_content
+        self.sniff_bytes = sniff_bytes
+        self.sniff_workers = sniff_workers
         self.lat_letters = "abcdefghijklmnopqrstuvwxyz1234567890"
         self.translit = {
             "а": "a",
@@ -322,107 +328,274 @@ class Sorter:
             "audio": ["mp3", "ogg", "wav", "amr"],
             "archives": ["zip", "gz", "tar"]
         }
+        # only zip is detected for archives: archives() can unpack nothing else
+        self.magic_signatures = [
+            (b"\xff\xd8\xff", "jpeg"),
+            (b"\x89PNG\r\n\x1a\n", "png"),
+            (b"\x1aE\xdf\xa3", "mkv"),
+            (b"%PDF-", "pdf"),
+            (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "doc"),
+            (b"ID3", "mp3"),
+            (b"\xff\xfb", "mp3"),
+            (b"\xff\xf3", "mp3"),
+            (b"\xff\xf2", "mp3"),
+            (b"OggS", "ogg"),
+            (b"#!AMR", "amr")
+        ]
+        self.video_brands = {
+            b"isom": "mp4",
+            b"iso2": "mp4",
+            b"mp41": "mp4",
+            b"mp42": "mp4",
+            b"avc1": "mp4",
+            b"M4V ": "mp4",
+            b"qt  ": "mov"
+        }
         self.white_list_dir = ["images", "video", "documents", "audio", "archives"]
+        self.translit_table = str.maketrans(
+            {**self.translit, **{key.upper(): value.upper() for key, value in self.translit.items()}}
+        )
+        # the Kelvin sign lowercases to "k", so the old per-letter check kept it as well
+        self.not_allowed_letters = re.compile(
+            "[^" + re.escape(
+                self.lat_letters + self.lat_letters.upper() + "".join(self.translit) + "".join(self.translit).upper()
+                + "\u212a"
+            ) + "]"
+        )
+        self.normalized_names = {}
+        self.rename_plan = {}
+        self.transfer_chunk = 2 ** 30
+        self.transfer_stats = {"renamed": 0, "copied": 0, "bytes": 0, "seconds": 0.0}
         self.known_extensions_in_folder = []
         self.unknown_extensions_in_folder = []
 
     def check_folder(self, path: str):
-        if path.split("\\")[-1] not in self.white_list_dir:
+        if os.path.basename(path) not in self.white_list_dir:
             for item in os.listdir(path):
                 if os.path.isfile(os.path.join(path, item)):
-                    if item.split(".")[-1] in self.known_extensions["images"]:
-                        if item.split(".")[-1] not in self.known_extensions_in_folder:
-                            self.known_extensions_in_folder.append(item.split(".")[-1])
-                        self.files_groups["images"].append(os.path.join(path, item))
-                    elif item.split(".")[-1] in self.known_extensions["video"]:
-                        if item.split(".")[-1] not in self.known_extensions_in_folder:
-                            self.known_extensions_in_folder.append(item.split(".")[-1])
-                        self.files_groups["video"].append(os.path.join(path, item))
-                    elif item.split(".")[-1] in self.known_extensions["documents"]:
-                        if item.split(".")[-1] not in self.known_extensions_in_folder:
-                            self.known_extensions_in_folder.append(item.split(".")[-1])
-                        self.files_groups["documents"].append(os.path.join(path, item))
-                    elif item.split(".")[-1] in self.known_extensions["audio"]:
-                        if item.split(".")[-1] not in self.known_extensions_in_folder:
-                            self.known_extensions_in_folder.append(item.split(".")[-1])
-                        self.files_groups["audio"].append(os.path.join(path, item))
-                    elif item.split(".")[-1] in self.known_extensions["archives"]:
-                        if item.split(".")[-1] not in self.known_extensions_in_folder:
-                            self.known_extensions_in_folder.append(item.split(".")[-1])
-                        self.files_groups["archives"].append(os.path.join(path, item))
+                    extension = item.split(".")[-1].lower()
+                    for group in self.white_list_dir:
+                        if extension in self.known_extensions[group]:
+                            if extension not in self.known_extensions_in_folder:
+                                self.known_extensions_in_folder.append(extension)
+                            self.files_groups[group].append(os.path.join(path, item))
+                            break
                     else:
-                        if item.split(".")[-1] not in self.unknown_extensions_in_folder:
-                            self.unknown_extensions_in_folder.append(item.split(".")[-1])
+                        if extension not in self.unknown_extensions_in_folder:
+                            self.unknown_extensions_in_folder.append(extension)
                         self.files_groups["others"].append(os.path.join(path, item))
                 else:
                     self.check_folder(os.path.join(path, item))
 
+    def sniff(self, filepath: str):
+        try:
+            with open(filepath, "rb") as file:
+                head = file.read(self.sniff_bytes)
+        except OSError:
+            return None
+        if head[4:8] == b"ftyp":
+            # HEIC/AVIF photos and M4A audio share this container, so only video brands count
+            return self.video_brands.get(head[8:12])
+        if head.startswith(b"RIFF"):
+            return {b"AVI ": "avi", b"WAVE": "wav"}.get(head[8:12])
+        if head.startswith(b"PK\x03\x04"):
+            # OOXML documents are zip files starting with their package metadata
+            if b"[Content_Types].xml" in head or b"_rels/" in head:
+                return "docx"
+            return "zip"
+        for signature, extension in self.magic_signatures:
+            if head.startswith(signature):
+                return extension
+        text = head.lstrip()
+        if text.startswith(b"<svg") or text.startswith(b"<?xml") and b"<svg" in text:
+            return "svg"
+        return None
+
+    def classify_by_content(self):
+        # content only decides for files whose extension told nothing
+        files = self.files_groups["others"]
+        with ThreadPoolExecutor(max_workers=self.sniff_workers) as executor:
+            extensions = list(executor.map(self.sniff, files))
+        self.files_groups["others"] = []
+        for file, extension in zip(files, extensions):
+            # zip containers such as .jar or .epub stay where they are, only bare zips are unpacked
+            if extension == "zip" and "." in os.path.basename(file):
+                extension = None
+            for group in self.white_list_dir:
+                if extension in self.known_extensions[group]:
+                    if extension not in self.known_extensions_in_folder:
+                        self.known_extensions_in_folder.append(extension)
+                    self.files_groups[group].append(file)
+                    break
+            else:
+                self.files_groups["others"].append(file)
+        unknown_extensions = {os.path.basename(file).split(".")[-1].lower() for file in self.files_groups["others"]}
+        self.unknown_extensions_in_folder = [
+            extension for extension in self.unknown_extensions_in_folder if extension in unknown_extensions
+        ]
+
     def normalize(self, filename):
-        translit_filename = ""
-        for letter in "".join(filename.split(".")[:-1]):
-            if letter.lower() in self.translit.keys():
-                if letter.islower():
-                    cur_letter = self.translit[letter]
+        if filename not in self.normalized_names:
+            name, dot, extension = filename.rpartition(".")
+            if not dot:
+                name, extension = extension, ""
+            name = self.not_allowed_letters.sub("_", name.replace(".", "")).translate(self.translit_table)
+            self.normalized_names[filename] = name + dot + extension
+        return self.normalized_names[filename]
+
+    def plan(self):
+        self.rename_plan = {}
+        for group in self.white_list_dir:
+            folder = os.path.join(self.filepath, group)
+            taken = set()
+            if os.path.isdir(folder):
+                # case-insensitive volumes (Windows, macOS) would let Foto.jpg replace foto.jpg
+                taken.update(item.casefold() for item in os.listdir(folder))
+            prefix = os.path.join(folder, "")
+            for file in sorted(self.files_groups[group]):
+                new_filename = self.normalize(os.path.basename(file))
+                if group == "archives":
+                    # extracting into the same folder again keeps repeated sorts from piling up copies
+                    self.rename_plan[file] = prefix + os.path.splitext(new_filename)[0]
+                    continue
+                key = new_filename.casefold()
+                if key in taken:
+                    name, extension = os.path.splitext(new_filename)
+                    index = 0
+                    while key in taken:
+                        index += 1
+                        new_filename = f"{name}_{index}{extension}"
+                        key = new_filename.casefold()
+                taken.add(key)
+                self.rename_plan[file] = prefix + new_filename
+        return self.rename_plan
+
+    def plan_sort(self, filepath: str):
+        self.filepath = filepath
+        self.files_groups = {group: [] for group in self.files_groups}
+        self.known_extensions_in_folder = []
+        self.unknown_extensions_in_folder = []
+        self.check_folder(self.filepath)
+        if self.sniff_content:
+            self.classify_by_content()
+        return self.plan()
+
+    def make_folders(self, groups):
+        for group in groups:
+            if self.files_groups[group] and not os.path.exists(os.path.join(self.filepath, group)):
+                os.mkdir(os.path.join(self.filepath, group))
+
+    def copy_file(self, src: str, dst: str):
+        created = False
+        try:
+            # the plan keeps dst free, so an existing file there is an error rather than something to truncate
+            with open(src, "rb") as file_src, open(dst, "xb") as file_dst:
+                created = True
+                infd, outfd = file_src.fileno(), file_dst.fileno()
+                copied = 0
+                for kernel_copy in ("copy_file_range", "sendfile"):
+                    if not hasattr(os, kernel_copy):
+                        continue
+                    try:
+                        while True:
+                            if kernel_copy == "sendfile":
+                                sent = os.sendfile(outfd, infd, copied, self.transfer_chunk)
+                            else:
+                                sent = os.copy_file_range(infd, outfd, self.transfer_chunk)
+                            if not sent:
+                                break
+                            copied += sent
+                        break
+                    except OSError:
+                        # the kernel refused this pair of files, try the next way unless data was already written
+                        if copied:
+                            raise
                 else:
-                    cur_letter = self.translit[letter.lower()].upper()
-            elif letter.lower() not in self.lat_letters:
-                cur_letter = "_"
-            else:
-                cur_letter = letter
-            translit_filename += cur_letter
-        translit_filename += "." + filename.split(".")[-1]
-        return translit_filename
-
-    def images(self, imgs):
-        for img in imgs:
-            new_filename = self.normalize(img.split("\\")[-1])
-            if not os.path.exists(os.path.join(self.filepath, "images")):
-                os.mkdir(os.path.join(self.filepath, "images"))
-            shutil.move(img, os.path.join(self.filepath, "images", new_filename))
-
-    def documents(self, docs):
-        for doc in docs:
-            new_filename = self.normalize(doc.split("\\")[-1])
-            if not os.path.exists(os.path.join(self.filepath, "documents")):
-                os.mkdir(os.path.join(self.filepath, "documents"))
-            shutil.move(doc, os.path.join(self.filepath, "documents", new_filename))
-
-    def audio(self, musics):
-        for music in musics:
-            new_filename = self.normalize(music.split("\\")[-1])
-            if not os.path.exists(os.path.join(self.filepath, "audio")):
-                os.mkdir(os.path.join(self.filepath, "audio"))
-            shutil.move(music, os.path.join(self.filepath, "audio", new_filename))
-
-    def video(self, videos):
-        for vid in videos:
-            new_filename = self.normalize(vid.split("\\")[-1])
-            if not os.path.exists(os.path.join(self.filepath, "video")):
-                os.mkdir(os.path.join(self.filepath, "video"))
-            shutil.move(vid, os.path.join(self.filepath, "video", new_filename))
+                    shutil.copyfileobj(file_src, file_dst)
+                    copied = file_dst.tell()
+                file_dst.flush()
+                os.fsync(outfd)
+            shutil.copystat(src, dst)
+            return copied
+        except BaseException:
+            # a partial copy would take the real file's name in the next plan
+            if created:
+                os.remove(dst)
+            raise
+
+    def sync_dirs(self, dirs):
+        if not hasattr(os, "O_DIRECTORY"):
+            return
+        for directory in dirs:
+            fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def transfer(self, files):
+        self.transfer_stats = {"renamed": 0, "copied": 0, "bytes": 0, "seconds": 0.0}
+        devices = {}
+        batches = {}
+        for file in files:
+            folder = os.path.dirname(self.rename_plan[file])
+            if folder not in devices:
+                devices[folder] = os.stat(folder).st_dev
+            batches.setdefault((os.stat(file).st_dev, devices[folder]), []).append(file)
+        for (src_device, dst_device), batch in batches.items():
+            copied = []
+            for file in batch:
+                new_file = self.rename_plan[file]
+                if src_device == dst_device:
+                    try:
+                        os.rename(file, new_file)
+                        self.transfer_stats["renamed"] += 1
+                        continue
+                    except OSError as error:
+                        # bind mounts of one filesystem share st_dev but still refuse to rename between them
+                        if error.errno != errno.EXDEV:
+                            raise
+                start = time.perf_counter()
+                self.transfer_stats["bytes"] += self.copy_file(file, new_file)
+                self.transfer_stats["seconds"] += time.perf_counter() - start
+                self.transfer_stats["copied"] += 1
+                copied.append(file)
+            # sources are removed only once their new entries are on disk, as the two filesystems are not ordered
+            self.sync_dirs({os.path.dirname(self.rename_plan[file]) for file in batch})
+            for file in copied:
+                os.remove(file)
+            self.sync_dirs({os.path.dirname(file) for file in batch})
+        return self.transfer_stats
 
     def archives(self, archive):
         for arc in archive:
-            new_filename = self.normalize(arc.split("\\")[-1])
-            new_filename = "".join(new_filename.split(".")[:-1])
             zip_file = zipfile.ZipFile(arc)
             if not os.path.exists(os.path.join(self.filepath, "archives")):
                 os.mkdir(os.path.join(self.filepath, "archives"))
-            zip_file.extractall(os.path.join(self.filepath, "archives", new_filename))
+            zip_file.extractall(self.rename_plan[arc])
 
-    def sort(self, filepath: str):
+    def sort(self, filepath: str, dry_run: bool = False):
         result = ""
-        self.filepath = filepath
-        self.check_folder(self.filepath)
+        self.plan_sort(filepath)
         result += "Known extension in folder:\n"
         result += "     " + ", ".join(self.known_extensions_in_folder) + "\n"
         result += "Unknown extension in folder:\n"
         result += "     " + ", ".join(self.unknown_extensions_in_folder) + "\n"
-        self.images(self.files_groups["images"])
-        self.documents(self.files_groups["documents"])
-        self.audio(self.files_groups["audio"])
-        self.video(self.files_groups["video"])
+        if dry_run:
+            result += "Planned moves:\n"
+            for file, new_file in self.rename_plan.items():
+                result += "     " + file + " -> " + new_file + "\n"
+            return result
+        groups = ["images", "documents", "audio", "video"]
+        self.make_folders(groups)
+        self.transfer([file for group in groups for file in self.files_groups[group]])
         self.archives(self.files_groups["archives"])
+        result += f"Renamed {self.transfer_stats['renamed']} files\n"
+        if self.transfer_stats["copied"]:
+            megabytes = self.transfer_stats["bytes"] / 2 ** 20
+            seconds = self.transfer_stats["seconds"] or 1e-9
+            result += f"Copied {self.transfer_stats['copied']} files ({megabytes:.1f} MB)"
+            result += f" at {megabytes / seconds:.1f} MB/s\n"
         result += "Files was sorted successfully"
         return result
 
@@ -449,7 +622,7 @@ def main():
         os.mkdir(os.path.expanduser(r"~\bot"))
     address_book = AddressBook()
     note_book = NoteBook()
-    sorter = Sorter()
+    sorter = Sorter(sniff_content=True)
     address_book.load()
     note_book.load()
     while True: